@@ -1,11 +1,20 @@
 from collections import defaultdict
 import datetime
+import os
+import threading
 import time
 
-from recommender import Recommender
+from recommender import Recommender, model_version
 import textminer
 
-recommender = Recommender()
+# Precision of the factor matrix: float64, float32 or int8
+precision = os.environ.get("RECOMMENDER_PRECISION", "float64")
+recommender = Recommender(precision)
+
+# Seconds between checks for a refreshed model on disk
+reload_interval = 60
+last_reload_check = time.time()
+reload_lock = threading.Lock()
 
 # Upper limit of phrases to display in word cloud
 word_limit = 50
@@ -42,6 +51,34 @@ def get_post_text(posts):
             yield post_data["selftext"]
 
 
+def _load_recommender():
+    global recommender
+    try:
+        recommender = Recommender(precision)
+    except SystemExit:
+        # Model files missing or being replaced, keep serving with the current model
+        pass
+    finally:
+        reload_lock.release()
+
+
+def reload_recommender():
+    """
+    Replaces the recommender if a refreshed model has been written to disk.
+
+    The new model is loaded in a background thread. Until it is ready, requests
+    keep using the current recommender, which is then swapped in one assignment.
+    """
+    global last_reload_check
+    now = time.time()
+    if now - last_reload_check < reload_interval:
+        return
+    last_reload_check = now
+
+    if model_version() != recommender.version and reload_lock.acquire(False):
+        threading.Thread(target=_load_recommender, daemon=True).start()
+
+
 def process(data):
     """
     Computes certain statistics from a user's post data.
@@ -94,6 +131,7 @@ def process(data):
     avg_score = total_score / post_count
 
     counts = dict((k, v["count"]) for k, v in subreddits.items())
+    reload_recommender()
     recommended = recommender.get_similar(counts)
 
     # Parse list of top_phrases into a suitable format for D3
@@ -3,21 +3,32 @@ reddit user-analytics app providing insights on how user spends time on reddit.
 Author: Rasmus Heikkila 2016
 """
 
+from flask import abort
 from flask import Flask
+from flask import json
 from flask import jsonify
 from flask import render_template
 from flask import request
 from flask.ext.pymongo import PyMongo
 from waitress import serve
 
+import atexit
+import gzip
+import hmac
 import logging
 import logging.handlers
 import os
 import re
+import subprocess
+import sys
+import threading
+import time
 
 from analytics import parse_date
 import analytics
+import profiling
 import reddit
+import warmer
 
 app = Flask(__name__)
 app.config.from_object(os.environ["APP_CONFIG"])
@@ -28,6 +39,8 @@ handler.setFormatter(formatter)
 app.logger.addHandler(handler)
 app.logger.setLevel(app.config["LOGGING_LEVEL"])
 
+popularity = warmer.Popularity(half_life=app.config["WARMER_HALF_LIFE"])
+
 with app.app_context():
     mongo = PyMongo(app)
     users = mongo.db.users
@@ -57,6 +70,35 @@ def valid(name):
         return False
 
 
+def make_payload(user_data):
+    """
+    Builds the response of /stats from the processed data of a user.
+
+    Returns a dictionary, with "error" key if the user has no posts.
+    """
+    if not (user_data.get("posts") or user_data.get("analytics")):
+        return {"error": "No posts were found!"}
+
+    statistics = user_data["analytics"]
+
+    return {
+        "postcount": len(user_data["posts"]),
+        "refreshed": user_data["refreshed"],
+        "account_created": parse_date(int(user_data["info"]["created_utc"])),
+        "oldest_post_date": user_data["posts"][-1]["data"]["created_utc"],
+        "total_karma": statistics["total_score"],
+        "words_per_post": "{:.1f}".format(statistics["avg_words"]),
+        "karma_per_word": "{:.2f}".format(statistics["karma_per_word"]),
+        "avgscore": "{:.1f}".format(statistics["avg_score"]),
+        "posts": user_data["posts"],
+        "subreddits": statistics["subreddits"],
+        "daydata": statistics["by_day"],
+        "hourdata": statistics["by_hour"],
+        "wordcount": statistics["top_phrases"],
+        "recommendations": statistics["recommendations"]
+    }
+
+
 def retrieve_data(username):
     """
     Returns a dictionary containing user data from reddit API and
@@ -67,6 +109,12 @@ def retrieve_data(username):
     result = reddit.api.user(username)
     if not "error" in result:
         data = analytics.process(result)
+        payload = make_payload(data)
+        if not "error" in payload:
+            # Serialize the response once here instead of on every request
+            body = json.dumps(payload).encode("utf-8")
+            data["payload"] = body
+            data["payload_gzip"] = gzip.compress(body)
         res = users.replace_one({"username": username}, data, upsert=True)
         if not res.acknowledged:
             app.logger.warning("Failed to write data of user: %s", username)
@@ -94,42 +142,117 @@ def stats(name):
         return jsonify(error="Invalid name")
 
     refresh = request.args.get("refresh") == "true"
+    gzipped = request.accept_encodings["gzip"]
+    field = "payload_gzip" if gzipped else "payload"
 
     if refresh:
         user_data = retrieve_data(name)
     else:
-        user_data = users.find_one({"username": name})
+        # Only the stored response is sent, so read no other fields
+        user_data = users.find_one({"username": name}, {field: 1})
         if not user_data:
             user_data = retrieve_data(name)
 
     if "error" in user_data:
         return jsonify(**user_data)
 
-    if not (user_data.get("posts") or user_data.get("analytics")):
-        return jsonify(error="No posts were found!")
+    if app.config["WARMER_ENABLED"]:
+        popularity.hit(name)
 
-    statistics = user_data["analytics"]
+    body = user_data.get(field)
+    if body is None:
+        # Data stored before responses were serialized at write time
+        if "info" not in user_data:
+            user_data = users.find_one({"username": name})
+        payload = make_payload(user_data)
+        return jsonify(**payload)
 
-    payload = {
-        "postcount": len(user_data["posts"]),
-        "refreshed": user_data["refreshed"],
-        "account_created": parse_date(int(user_data["info"]["created_utc"])),
-        "oldest_post_date": user_data["posts"][-1]["data"]["created_utc"],
-        "total_karma": statistics["total_score"],
-        "words_per_post": "{:.1f}".format(statistics["avg_words"]),
-        "karma_per_word": "{:.2f}".format(statistics["karma_per_word"]),
-        "avgscore": "{:.1f}".format(statistics["avg_score"]),
-        "posts": user_data["posts"],
-        "subreddits": statistics["subreddits"],
-        "daydata": statistics["by_day"],
-        "hourdata": statistics["by_hour"],
-        "wordcount": statistics["top_phrases"],
-        "recommendations": statistics["recommendations"]
-    }
-    return jsonify(**payload)
+    response = app.response_class(body, mimetype="application/json")
+    response.vary.add("Accept-Encoding")
+    if gzipped:
+        response.content_encoding = "gzip"
+    return response
+
+
+# The profiler only wraps the view if enabled, so it costs nothing otherwise
+if app.config["PROFILE_SAMPLE_RATE"] or app.config["PROFILE_TOKEN"]:
+    profile_file = os.path.splitext(app.config["LOGGING_FILE"])[0] + ".prof"
+    profiler = profiling.RequestProfiler(profile_file,
+                                         sample_rate=app.config["PROFILE_SAMPLE_RATE"],
+                                         batch=app.config["PROFILE_BATCH"],
+                                         backup_count=app.config["PROFILE_BACKUP_COUNT"])
+    app.view_functions["stats"] = profiler.wrap(stats)
+    atexit.register(profiler.flush)
+    app.logger.info("Profiling requests to %s", profile_file)
+
+    @app.route("/profile/<name>")
+    def profile(name):
+        """
+        Enables profiling of all requests for a username, or disables it
+        with enable=false. Requires the admin token as parameter token.
+        """
+        token = app.config["PROFILE_TOKEN"]
+        given = request.args.get("token", "")
+        if not token or not hmac.compare_digest(given.encode(), token.encode()):
+            abort(403)
+
+        if request.args.get("enable") == "false":
+            profiler.users.discard(name)
+        else:
+            profiler.users.add(name)
+        return jsonify(profiled=sorted(profiler.users))
+
+
+def warm_user(username):
+    """
+    Refreshes the data of a user outside of a request.
+    """
+    with app.app_context():
+        try:
+            result = retrieve_data(username)
+            if "error" in result:
+                app.logger.warning("Could not refresh user %s: %s", username, result["error"])
+        except Exception as e:
+            app.logger.error("Failed to refresh user %s: %s", username, str(e))
+
+
+def data_age(username):
+    """
+    Returns seconds since the data of a user was retrieved, or None if unknown.
+    """
+    user_data = users.find_one({"username": username}, {"refreshed_utc": 1})
+    if not user_data or "refreshed_utc" not in user_data:
+        return None
+    return time.time() - user_data["refreshed_utc"]
+
+
+def refresh_model(interval):
+    """
+    Runs model/refresh.py every interval seconds in a subprocess.
+
+    The refresh has to write to the filesystem of this process, where
+    analytics looks for the updated model. On Heroku, a separate dyno
+    has a filesystem of its own and its refresh would never be seen.
+    """
+    while True:
+        time.sleep(interval)
+        code = subprocess.call([sys.executable, "refresh.py"], cwd="model")
+        if code:
+            app.logger.error("Model refresh failed with exit code %d", code)
 
 
 if __name__ == "__main__":
     #app.run()
+    if app.config["MODEL_REFRESH_INTERVAL"]:
+        threading.Thread(target=refresh_model, args=(app.config["MODEL_REFRESH_INTERVAL"],),
+                         daemon=True).start()
+    if app.config["WARMER_ENABLED"]:
+        # Started here, as reddit.api does not exist yet when reddit imports this module
+        warmer.CacheWarmer(popularity, reddit.api, warm_user, data_age,
+                           max_age=app.config["WARMER_MAX_AGE"],
+                           budget=app.config["WARMER_BUDGET"],
+                           reserve=app.config["WARMER_RESERVE"],
+                           cost=reddit.post_limit // 100 + 1,
+                           logger=app.logger).start()
     port = int(os.environ.get('PORT', 5000))
     serve(app, host="0.0.0.0", port=port)
@@ -11,6 +11,25 @@ class Config(object):
     LOGGING_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
     LOGGING_FILE = "app.log"
     LOGGING_LEVEL = logging.WARNING
+    # Fraction of /stats requests profiled, profiling is disabled if 0 and no token is set
+    PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", 0))
+    # Token required for enabling profiling of a username at /profile/<name>
+    PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN")
+    # Profiled requests aggregated in one file and number of rotated files kept
+    PROFILE_BATCH = 50
+    PROFILE_BACKUP_COUNT = 5
+    # Seconds between refreshes of the recommendation model by the web process, 0 disables
+    MODEL_REFRESH_INTERVAL = int(os.environ.get("MODEL_REFRESH_INTERVAL", 0))
+    # Refresh popular profiles in the background with spare reddit API requests
+    WARMER_ENABLED = os.environ.get("WARMER_ENABLED") == "true"
+    # Seconds after which a view counts half in popularity
+    WARMER_HALF_LIFE = 24 * 3600
+    # Seconds after which the data of a popular profile is refreshed
+    WARMER_MAX_AGE = 6 * 3600
+    # Share of the reddit API ratelimit the warmer may use per minute
+    WARMER_BUDGET = 0.25
+    # Requests per minute always left for interactive requests
+    WARMER_RESERVE = 20
 
 
 class DevelopmentConfig(Config):
@@ -0,0 +1,229 @@
+"""
+Implicit feedback matrix factorization by alternating least squares.
+
+Implements the model of Hu, Koren and Volinsky (http://yifanhu.net/PUB/cf.pdf).
+Each half-iteration solves one side of the factorization with a few steps of
+conjugate gradient, warm-started from the previous factors. Rows are solved in
+blocks: for a block of rows the products with the system matrices are computed
+together, using the precomputed Gram matrix Y^T Y of the fixed factors plus a
+sparse correction for the observed entries only. Blocks are distributed over a
+process pool that works on factor and matrix arrays in shared memory.
+"""
+import logging
+import multiprocessing
+import multiprocessing.sharedctypes
+import time
+
+import numpy as np
+import scipy.sparse
+
+# Arrays used by _solve_block, set up in each process by _init_arrays
+_arrays = {}
+
+# Maximum number of observed entries handled by one block
+block_nnz = 2 ** 18
+
+
+def _shared_array(a):
+    """
+    Copies an array into shared memory.
+
+    Returns:
+        Tuple of the shared buffer, dtype and shape, from which a numpy
+        view is rebuilt with _view.
+    """
+    a = np.ascontiguousarray(a)
+    typecode = {np.dtype(np.float64): "d", np.dtype(np.int64): "q"}[a.dtype]
+    raw = multiprocessing.sharedctypes.RawArray(typecode, max(a.size, 1))
+    shared = (raw, a.dtype.str, a.shape)
+    _view(shared)[...] = a
+    return shared
+
+
+def _view(shared):
+    raw, dtype, shape = shared
+    return np.frombuffer(raw, dtype=dtype)[:int(np.prod(shape))].reshape(shape)
+
+
+def _init_arrays(shared):
+    """
+    Initializes the arrays of a process from their shared buffers.
+    """
+    _arrays.clear()
+    for name, a in shared.items():
+        _arrays[name] = _view(a)
+
+
+def _blocks(indptr, max_nnz):
+    """
+    Splits the rows of a CSR matrix into consecutive blocks of at most
+    max_nnz observed entries (or a single row, if a row alone has more).
+
+    Returns:
+        list of (start, end) row ranges
+    """
+    n = len(indptr) - 1
+    blocks = list()
+    start = 0
+    while start < n:
+        end = np.searchsorted(indptr, indptr[start] + max_nnz, side="right") - 1
+        end = min(max(end, start + 1), n)
+        blocks.append((start, end))
+        start = end
+    return blocks
+
+
+def _solve_block(task):
+    """
+    Updates a block of rows of one factor matrix with conjugate gradient steps.
+
+    The system solved for each row u is
+        (Y^T Y + reg * I + Y^T (C_u - I) Y) x_u = Y^T C_u p_u
+    where Y is the fixed factor matrix and C_u the confidences of row u.
+    If the rows are anchored to prior factors, reg includes the anchor weight
+    and the weighted prior is added to the right-hand side.
+
+    Args:
+        task: tuple (side, start, end, cg_steps), side being "X" to solve the
+              rows of the matrix and "Y" to solve the columns
+    """
+    side, start, end, cg_steps = task
+    other = "Y" if side == "X" else "X"
+    X = _arrays[side]
+    Y = _arrays[other]
+    gram = _arrays["gram"]
+
+    indptr = _arrays[side + "_indptr"][start:end + 1]
+    lo, hi = indptr[0], indptr[-1]
+    indptr = indptr - lo
+    indices = _arrays[side + "_indices"][lo:hi]
+    confidence = _arrays[side + "_data"][lo:hi]
+    shape = (end - start, Y.shape[0])
+
+    rows = np.repeat(np.arange(end - start), np.diff(indptr))
+    Yi = Y[indices]
+
+    def product(v):
+        # Y^T (C_u - I) Y v only involves the observed entries of each row
+        w = (confidence - 1.0) * np.einsum("ij,ij->i", Yi, v[rows])
+        correction = scipy.sparse.csr_matrix((w, indices, indptr), shape=shape)
+        return v.dot(gram) + correction.dot(Y)
+
+    x = X[start:end].copy()
+    b = scipy.sparse.csr_matrix((confidence, indices, indptr), shape=shape).dot(Y)
+    prior = _arrays.get(side + "_prior")
+    if prior is not None:
+        b += prior[start:end]
+    r = b - product(x)
+    p = r.copy()
+    rsold = np.einsum("ij,ij->i", r, r)
+
+    for _ in range(cg_steps):
+        if not rsold.any():
+            break
+        Ap = product(p)
+        pAp = np.einsum("ij,ij->i", p, Ap)
+        alpha = np.divide(rsold, pAp, out=np.zeros_like(rsold), where=pAp > 0)
+        x += alpha[:, np.newaxis] * p
+        r -= alpha[:, np.newaxis] * Ap
+        rsnew = np.einsum("ij,ij->i", r, r)
+        beta = np.divide(rsnew, rsold, out=np.zeros_like(rsnew), where=rsold > 0)
+        p = r + beta[:, np.newaxis] * p
+        rsold = rsnew
+
+    X[start:end] = x
+
+
+def _loss(Cui, X, Y, regularization):
+    """
+    Calculates the weighted squared error of the factorization
+    averaged over the confidence of all entries, including regularization.
+    """
+    # Sum of (x_u . y_i)^2 over all entries, computed through the Gram matrices
+    loss = np.sum(X.T.dot(X) * Y.T.dot(Y))
+    for start, end in _blocks(Cui.indptr, block_nnz):
+        block = Cui[start:end]
+        rows = np.repeat(np.arange(start, end), np.diff(block.indptr))
+        xy = np.einsum("ij,ij->i", X[rows], Y[block.indices])
+        # Replace the unit-confidence term of observed entries with the weighted one
+        loss += np.sum(block.data * (1.0 - xy) ** 2 - xy ** 2)
+    loss += regularization * (np.sum(X ** 2) + np.sum(Y ** 2))
+
+    total_confidence = Cui.data.sum() + Cui.shape[0] * Cui.shape[1] - Cui.nnz
+    return loss / total_confidence
+
+
+def alternating_least_squares(Cui, factors=50, regularization=0.01,
+                              iterations=15, cg_steps=3, processes=None,
+                              random_state=None, initial=None, anchor=0.0):
+    """
+    Factorizes the confidence matrix Cui into row and column factors.
+
+    Args:
+        Cui: sparse matrix of confidences, e.g. BM25 weighted post counts
+        factors: number of latent factors
+        regularization: L2 regularization of the factors
+        iterations: number of alternating sweeps over rows and columns
+        cg_steps: conjugate gradient steps per row and sweep
+        processes: size of the process pool, defaults to the number of CPUs.
+                   With a single process, blocks are solved in this process.
+        random_state: seed for initializing the factors
+        initial: row factors to start from instead of random ones. The column
+                 factors are then solved first.
+        anchor: weight of a penalty on the distance of the row factors from
+                initial, which keeps them close to a previously trained model
+                when Cui only covers part of the data
+    Returns:
+        Tuple of row factors and column factors.
+    """
+    Cui = scipy.sparse.csr_matrix(Cui, dtype=np.float64)
+    Ciu = Cui.T.tocsr()
+    processes = processes or multiprocessing.cpu_count()
+
+    rng = np.random.RandomState(random_state)
+    shared = {
+        "X": _shared_array(rng.rand(Cui.shape[0], factors) * 0.01),
+        "Y": _shared_array(rng.rand(Cui.shape[1], factors) * 0.01),
+        "gram": _shared_array(np.zeros((factors, factors)))
+    }
+    sides = [("X", "Y"), ("Y", "X")]
+    if initial is not None:
+        shared["X"] = _shared_array(initial.astype(np.float64))
+        sides.reverse()
+    if anchor:
+        shared["X_prior"] = _shared_array(anchor * _view(shared["X"]))
+    for side, C in (("X", Cui), ("Y", Ciu)):
+        shared[side + "_indptr"] = _shared_array(C.indptr.astype(np.int64))
+        shared[side + "_indices"] = _shared_array(C.indices.astype(np.int64))
+        shared[side + "_data"] = _shared_array(C.data)
+
+    _init_arrays(shared)
+    X, Y, gram = _arrays["X"], _arrays["Y"], _arrays["gram"]
+    blocks = {"X": _blocks(Cui.indptr, block_nnz), "Y": _blocks(Ciu.indptr, block_nnz)}
+
+    pool = None
+    if processes > 1:
+        pool = multiprocessing.Pool(processes, initializer=_init_arrays, initargs=(shared,))
+
+    try:
+        for iteration in range(iterations):
+            start = time.time()
+            for side, other in sides:
+                fixed = _arrays[other]
+                weight = regularization + (anchor if side == "X" else 0.0)
+                gram[...] = fixed.T.dot(fixed) + weight * np.eye(factors)
+                tasks = [(side, s, e, cg_steps) for s, e in blocks[side]]
+                if pool is not None:
+                    pool.map(_solve_block, tasks)
+                else:
+                    for task in tasks:
+                        _solve_block(task)
+            elapsed = time.time() - start
+            logging.debug("Iteration %d: loss %.6f in %.2fs", iteration + 1,
+                          _loss(Cui, X, Y, regularization), elapsed)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return X.copy(), Y.copy()
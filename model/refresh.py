@@ -0,0 +1,140 @@
+"""
+Refreshes the recommendation model with the users analysed by the web app.
+
+The post counts stored in the users collection are folded into the current
+subreddit factors with a few ALS sweeps that start from, and are anchored to,
+the current model. Subreddits missing from the vocabulary are added when
+enough users post in them. The files are replaced atomically and the version
+file is written last, which makes the running workers reload the model.
+
+Run from the model directory, like train.py, on the same filesystem as the web
+process. On Heroku, each dyno has a filesystem of its own, so the web process
+starts the refresh itself when MODEL_REFRESH_INTERVAL is set.
+"""
+import logging
+import os
+import pickle
+import time
+
+import numpy as np
+import pymongo
+import scipy.sparse
+
+from als import alternating_least_squares
+from train import atomic_write, bm25_weight, save_factor_variants
+
+
+def load_users(uri):
+    """
+    Reads post counts of all analysed users from the database.
+
+    Args:
+        uri: MongoDB connection string of the web app database
+    Returns:
+        generator of dictionaries of (subreddit, postcount) pairs
+    """
+    db = pymongo.MongoClient(uri).get_default_database()
+    query = {"analytics.subreddits": {"$exists": True}}
+    for user in db.users.find(query, {"analytics.subreddits": 1}):
+        subreddits = user["analytics"]["subreddits"]
+        yield dict((s["name"].lower(), s["data"]["count"]) for s in subreddits)
+
+
+def extend_vocabulary(subreddits, user_counts, min_users=5):
+    """
+    Adds subreddits that at least min_users users post in to the vocabulary.
+
+    Args:
+        subreddits: dictionary mapping indices to subreddit names
+        user_counts: list of dictionaries of (subreddit, postcount) pairs
+        min_users: number of users required for a new subreddit
+    Returns:
+        Extended dictionary, new subreddits having the indices after the old ones.
+    """
+    known = set(subreddits.values())
+    users = dict()
+    for counts in user_counts:
+        for name in counts:
+            if name not in known:
+                users[name] = users.get(name, 0) + 1
+
+    extended = dict(subreddits)
+    for name in sorted(k for k, v in users.items() if v >= min_users):
+        extended[len(extended)] = name
+    return extended
+
+
+def build_matrix(user_counts, subreddits):
+    """
+    Creates a sparse subreddit/user post count matrix like load_data in train.py.
+    Subreddits outside the vocabulary are skipped.
+    """
+    vectorizer = dict((v, k) for k, v in subreddits.items())
+    rows, cols, data = list(), list(), list()
+    for user, counts in enumerate(user_counts):
+        for name, count in counts.items():
+            idx = vectorizer.get(name)
+            if idx is not None:
+                rows.append(idx)
+                cols.append(user)
+                data.append(count)
+
+    shape = (len(subreddits), len(user_counts))
+    return scipy.sparse.coo_matrix((np.array(data, dtype=np.float64), (rows, cols)), shape=shape)
+
+
+def refresh_model(uri, iterations=3, anchor=10.0, min_users=5, processes=None):
+    """
+    Updates factors.pickle, its reduced precision variants and dict.pickle in
+    the working directory with the users stored in the database.
+
+    Args:
+        uri: MongoDB connection string of the web app database
+        iterations: number of ALS sweeps
+        anchor: weight keeping the factors close to the current model
+        min_users: number of users required to add a new subreddit
+        processes: size of the ALS process pool
+    """
+    with open("factors.pickle", "rb") as f:
+        subr_factors = pickle.load(f)
+    with open("params.pickle", "rb") as b:
+        params = pickle.load(b)
+    with open("dict.pickle", "rb") as d:
+        subreddits = pickle.load(d)
+
+    logging.debug("Reading users from database")
+    user_counts = list(load_users(uri))
+    logging.debug("Read %d users", len(user_counts))
+
+    subreddits = extend_vocabulary(subreddits, user_counts, min_users)
+    added = len(subreddits) - subr_factors.shape[0]
+    logging.debug("Adding %d new subreddits", added)
+
+    # New subreddits start from small random factors, as in training
+    initial = np.vstack([subr_factors,
+                         np.random.rand(added, subr_factors.shape[1]) * 0.01])
+    weighted, _ = bm25_weight(build_matrix(user_counts, subreddits),
+                              K1=params["K1"], B=params["B"])
+
+    start = time.time()
+    subr_factors, _ = alternating_least_squares(weighted,
+                                                factors=subr_factors.shape[1],
+                                                regularization=params["regularization"],
+                                                iterations=iterations,
+                                                processes=processes,
+                                                initial=initial,
+                                                anchor=anchor)
+    logging.debug("Refreshed factors in %s", time.time() - start)
+
+    atomic_write("dict.pickle", lambda d: pickle.dump(subreddits, d))
+    atomic_write("factors.pickle", lambda f: pickle.dump(subr_factors, f))
+    save_factor_variants(subr_factors)
+    # Workers reload the model when the version changes
+    atomic_write("version", lambda v: v.write(str(time.time()).encode()))
+
+    logging.debug("Refresh complete")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    refresh_model(os.environ.get("MONGODB_URI", "mongodb://localhost:27017/rest"))
@@ -1,12 +1,15 @@
+import argparse
 import pickle
 import logging
+import os
 import time
 
-from implicit import alternating_least_squares
 import numpy as np
 import pandas
 import scipy.sparse
 
+from als import alternating_least_squares
+
 
 def load_data(file):
     """
@@ -70,10 +73,103 @@ class TopRelated(object):
         return sorted(zip(best, scores[best]), key=lambda x: -x[1])
 
 
+def quantize_factors(factors):
+    """
+    Quantizes each row of the factor matrix to int8 with its own scale.
+
+    Args:
+        factors: dense factor matrix
+    Returns:
+        Dictionary with int8 matrix "codes" and float32 vector "scales",
+        such that codes * scales[:, np.newaxis] approximates factors, and the
+        Gram matrix "gram" of factors, so that the recommender does not need
+        to read the whole float32 matrix for it.
+    """
+    scales = np.abs(factors).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    codes = np.rint(factors / scales[:, np.newaxis]).astype(np.int8)
+    return {"codes": codes, "scales": scales.astype(np.float32),
+            "gram": factors.T.dot(factors).astype(np.float32)}
+
+
+class QuantizedRelated(object):
+    """
+    Finds related items like the int8 mode of Recommender._scores: candidates
+    are preselected with the int8 factors and re-ranked with float32 factors.
+    """
+    def __init__(self, quantized, factors, rerank=5):
+        self.codes = quantized["codes"]
+        self.scales = quantized["scales"]
+        self.factors = factors
+        self.rerank = rerank
+
+    def get_related(self, id, n=10):
+        query = self.factors[id]
+        approx = self.codes.dot(query) * self.scales
+        k = min(n * self.rerank, len(approx))
+        candidates = np.argpartition(approx, -k)[-k:]
+        scores = self.factors[candidates].dot(query)
+        best = np.argpartition(scores, -n)[-n:]
+        return sorted(zip(candidates[best], scores[best]), key=lambda x: -x[1])
+
+
+def ranking_overlap(reference, approximate, n=10):
+    """
+    Measures how well the top n related items of a reduced precision model
+    agree with the full precision ranking.
+
+    Args:
+        reference (TopRelated): full precision model
+        approximate (TopRelated): reduced precision model
+        n: length of the compared rankings
+    Returns:
+        Average fraction of the reference top n found in the approximate top n.
+    """
+    overlaps = list()
+    for i in range(reference.factors.shape[0]):
+        expected = set(idx for idx, _ in reference.get_related(i, n))
+        found = set(idx for idx, _ in approximate.get_related(i, n))
+        overlaps.append(len(expected & found) / n)
+    return np.mean(overlaps)
+
+
+def atomic_write(filename, write):
+    """
+    Writes a file through a temporary file, so that readers of the model
+    never see a partially written file.
+
+    Args:
+        filename: target file
+        write: function writing the contents into a binary file object
+    """
+    tmp = filename + ".tmp"
+    with open(tmp, "wb") as f:
+        write(f)
+    os.replace(tmp, filename)
+
+
+def save_factor_variants(subr_factors):
+    """
+    Writes the normalized factor matrix in float32 and int8 precision
+    and logs their ranking agreement with the float64 model.
+    """
+    model = TopRelated(subr_factors)
+    factors32 = model.factors.astype(np.float32)
+    atomic_write("factors32.npy", lambda f: np.save(f, factors32))
+
+    quantized = quantize_factors(factors32)
+    atomic_write("factors8.pickle", lambda f: pickle.dump(quantized, f))
+
+    logging.debug("float32 top-10 overlap with float64: %s",
+                  ranking_overlap(model, TopRelated(factors32)))
+    logging.debug("int8 top-10 overlap with float64: %s",
+                  ranking_overlap(model, QuantizedRelated(quantized, factors32)))
+
+
 def train_model(input_filename, output_filename,
                 factors=50, regularization=0.01,
-                iterations=15, use_native=True,
-                cg=True):
+                iterations=15, cg_steps=3,
+                processes=None):
     logging.debug("Reading data from %s", input_filename)
     start = time.time()
     df, plays = load_data(input_filename)
@@ -89,9 +185,8 @@ def train_model(input_filename, output_filename,
                                                            factors=factors,
                                                            regularization=regularization,
                                                            iterations=iterations,
-                                                           use_native=use_native,
-                                                           dtype=np.float64,
-                                                           use_cg=cg)
+                                                           cg_steps=cg_steps,
+                                                           processes=processes)
     logging.debug("Calculated factors in %s", time.time() - start)
 
     logging.debug("Writing model to disk")
@@ -106,6 +201,8 @@ def train_model(input_filename, output_filename,
     with open("factors.pickle", "wb") as f:
         pickle.dump(subr_factors, f)
 
+    save_factor_variants(subr_factors)
+
     model = TopRelated(subr_factors)
     # Print 10 most similar subreddits for each subreddit to evaluate the model
     with open(output_filename, "w") as out:
@@ -118,5 +215,14 @@ def train_model(input_filename, output_filename,
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train the subreddit recommendation model.")
+    parser.add_argument("--variants-only", action="store_true",
+                        help="only write the float32 and int8 factors of the existing factors.pickle")
+    args = parser.parse_args()
+
     logging.basicConfig(level=logging.DEBUG)
-    train_model("users.csv", "similarities.txt")
+    if args.variants_only:
+        with open("factors.pickle", "rb") as f:
+            save_factor_variants(pickle.load(f))
+    else:
+        train_model("users.csv", "similarities.txt")
@@ -0,0 +1,128 @@
+"""
+Profiling of request handling on live traffic.
+
+RequestProfiler wraps a view function and runs cProfile on a random fraction of
+requests, and on every request for usernames selected by an administrator.
+Profiles are aggregated and written in batches to a file that is rotated like
+the log file.
+
+Times are CPU time of the profiled thread, so that the summary shows where the
+processing goes rather than time spent waiting on the reddit API or the database.
+Python before 3.7 has no per-thread CPU clock, and there the CPU time of the
+whole process is used, which includes other requests served in parallel.
+
+Run this module to merge the files and summarise them by function:
+
+    python profiling.py app.prof app.prof.1 -n 30 --sort tottime
+"""
+import argparse
+import cProfile
+import functools
+import os
+import pstats
+import random
+import threading
+import time
+
+
+# CPU time of the calling thread where available
+cpu_timer = getattr(time, "thread_time", time.process_time)
+
+
+class RequestProfiler(object):
+    """
+    Collects profiles of a view function.
+
+    Args:
+        filename: file the aggregated profiles are written to
+        sample_rate: fraction of requests profiled
+        batch: number of profiled requests aggregated in one file
+        backup_count: number of rotated files kept in addition to filename
+    """
+    def __init__(self, filename, sample_rate=0.0, batch=50, backup_count=5):
+        self.filename = filename
+        self.sample_rate = sample_rate
+        self.batch = batch
+        self.backup_count = backup_count
+        # Usernames whose every request is profiled
+        self.users = set()
+        self.stats = None
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def wrap(self, view):
+        """
+        Returns the view function profiling the sampled requests.
+        The view is expected to take the username as argument "name".
+        """
+        @functools.wraps(view)
+        def profiled_view(*args, **kwargs):
+            if kwargs.get("name") not in self.users and random.random() >= self.sample_rate:
+                return view(*args, **kwargs)
+
+            profile = cProfile.Profile(cpu_timer)
+            try:
+                return profile.runcall(view, *args, **kwargs)
+            finally:
+                self.add(profile)
+
+        return profiled_view
+
+    def add(self, profile):
+        """
+        Adds a profile to the current batch, writing the batch when it is full.
+        """
+        with self.lock:
+            if self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+            self.count += 1
+            if self.count >= self.batch:
+                self._write()
+
+    def flush(self):
+        """
+        Writes the current batch even if it is not full.
+        """
+        with self.lock:
+            if self.stats is not None:
+                self._write()
+
+    def _write(self):
+        self._rotate()
+        self.stats.dump_stats(self.filename)
+        self.stats = None
+        self.count = 0
+
+    def _rotate(self):
+        """
+        Renames filename to filename.1, filename.1 to filename.2 and so on,
+        dropping the oldest file like logging.handlers.RotatingFileHandler.
+        """
+        if not self.backup_count:
+            return
+        for i in range(self.backup_count - 1, 0, -1):
+            src = "{}.{}".format(self.filename, i)
+            if os.path.exists(src):
+                os.replace(src, "{}.{}".format(self.filename, i + 1))
+        if os.path.exists(self.filename):
+            os.replace(self.filename, self.filename + ".1")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge and summarise request profiles.")
+    parser.add_argument("files", nargs="+", help="profile files written by RequestProfiler")
+    parser.add_argument("-n", type=int, default=25, help="number of functions shown")
+    parser.add_argument("--sort", default="cumulative",
+                        help="sort key, e.g. cumulative, tottime or ncalls")
+    args = parser.parse_args()
+
+    stats = pstats.Stats(*args.files)
+    print("Times are CPU seconds ({}), excluding waits on network and database".format(
+        cpu_timer.__name__))
+    stats.strip_dirs().sort_stats(args.sort).print_stats(args.n)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,8 +5,28 @@ import numpy as np
 import scipy.sparse
 
 factors_file = "model/factors.pickle"
+factors32_file = "model/factors32.npy"
+factors8_file = "model/factors8.pickle"
 params_file = "model/params.pickle"
 vectorizer_file = "model/dict.pickle"
+# Rewritten by model/refresh.py after it has updated the other files
+version_file = "model/version"
+
+precisions = ("float64", "float32", "int8")
+
+# Rows of the int8 matrix converted to float at a time when scoring
+score_block = 2 ** 14
+
+
+def model_version():
+    """
+    Returns the version of the model files on disk, or None for the original model.
+    """
+    try:
+        with open(version_file, "r") as v:
+            return v.read()
+    except FileNotFoundError:
+        return None
 
 
 class Recommender(object):
@@ -18,23 +38,56 @@ class Recommender(object):
     - matrix of item (subreddit) factors
     - parameters of BM25 ranking and regularization
     - dictionary mapping indices to subreddit names
+
+    The factor matrix can be loaded in reduced precision:
+    - "float64": full precision factors (default)
+    - "float32": single precision factors
+    - "int8": factors quantized with a per-row scale. Candidates are scored with the
+      quantized matrix and the best ones re-ranked with float32 factors, which are
+      memory mapped so that only the rows touched by re-ranking are read. This mode
+      saves memory, but scoring is slower than with float32 factors.
     """
-    def __init__(self):
+    def __init__(self, precision="float64", rerank=5):
+        if precision not in precisions:
+            raise ValueError("Unknown precision: {}".format(precision))
+        self.precision = precision
+        # Number of candidates re-ranked per requested recommendation in int8 mode
+        self.rerank = rerank
+        dtype = np.float64 if precision == "float64" else np.float32
+        # Read before the model files, so that an update during loading is seen later
+        self.version = model_version()
+
         try:
-            with open(factors_file, "rb") as f:
-                factors = pickle.load(f)
-            norms = np.linalg.norm(factors, axis=-1)
-            self.factors = factors / norms[:, np.newaxis]
-            self.f = self.factors.shape[1]
-            # Precompute factor matrix product and add regularization
-            self.A = self.factors.T.dot(self.factors) + 0.01 * np.eye(self.f)
+            if precision == "int8":
+                with open(factors8_file, "rb") as f:
+                    quantized = pickle.load(f)
+                self.codes = quantized["codes"]
+                self.scales = quantized["scales"].astype(np.float32)
+                self.factors = np.load(factors32_file, mmap_mode="r")
+                self.f = self.codes.shape[1]
+                # Gram matrix of the float32 rows used in the user solve,
+                # stored with the codes so that the memory map is not read here
+                gram = quantized["gram"]
+            else:
+                if precision == "float32":
+                    factors = np.load(factors32_file)
+                else:
+                    with open(factors_file, "rb") as f:
+                        factors = pickle.load(f)
+                norms = np.linalg.norm(factors, axis=-1)
+                self.factors = (factors / norms[:, np.newaxis]).astype(dtype)
+                self.f = self.factors.shape[1]
+                # Precompute factor matrix product
+                gram = self.factors.T.dot(self.factors)
+            # Add regularization
+            self.A = gram + 0.01 * np.eye(self.f, dtype=dtype)
 
             with open(params_file, "rb") as b:
                 params = pickle.load(b)
             self.K1 = params["K1"]
             self.B = params["B"]
             self.avg_len = params["avg_length"]
-            self.idf = params["idf"]
+            self.idf = params["idf"].astype(dtype)
             self.regularization = params["regularization"]
 
             with open(vectorizer_file, "rb") as d:
@@ -42,6 +95,13 @@ class Recommender(object):
             # Pickled file contains inverse transformation (idx -> subreddit),
             # we also need (subreddit -> idx)
             self.vectorizer = dict((v, k) for k, v in self.inverse_vectorizer.items())
+
+            # The files are replaced one at a time during a refresh of the model
+            sizes = set([len(self.inverse_vectorizer), self.factors.shape[0]])
+            if precision == "int8":
+                sizes.update([self.codes.shape[0], self.scales.shape[0]])
+            if len(sizes) > 1:
+                sys.exit("Model files do not match: sizes {}".format(sorted(sizes)))
         except (FileNotFoundError, KeyError) as e:
             sys.exit("Model missing: {}".format(str(e)))
         except:
@@ -70,18 +130,47 @@ class Recommender(object):
         Returns:
             vector of user
         """
-        A = self.A
-        b = np.zeros(self.f)
+        A = self.A.copy()
+        b = np.zeros(self.f, dtype=A.dtype)
         nonzero = np.nonzero(c)
         c = c.tocsr()
         for i in np.nditer(nonzero):
-            factor = self.factors[i[1]]
+            factor = np.asarray(self.factors[i[1]], dtype=A.dtype)
             confidence = c[i]
             A += (confidence - 1.0) * np.outer(factor, factor)
             b += confidence * factor
 
         return np.linalg.solve(A, b)
 
+    def _scores(self, preferences, n):
+        """
+        Scores all subreddits against the user weights.
+
+        In int8 mode, the quantized matrix preselects n * rerank candidates, which
+        are then scored with the float32 factors. Other subreddits get score -inf.
+
+        Args:
+            preferences: vector of user weights
+            n: number of subreddits the caller needs from the top of the ranking
+        Returns:
+            vector of scores, one per subreddit
+        """
+        if self.precision != "int8":
+            return self.factors.dot(preferences)
+
+        # Score in blocks so that no float copy of the whole matrix is made
+        preferences = preferences.astype(np.float32)
+        approx = np.empty(len(self.codes), dtype=np.float32)
+        for start in range(0, len(self.codes), score_block):
+            block = self.codes[start:start + score_block]
+            approx[start:start + score_block] = block.dot(preferences)
+        approx *= self.scales
+        k = min(n * self.rerank, len(approx))
+        candidates = np.argpartition(approx, -k)[-k:]
+        scores = np.full(len(approx), -np.inf, dtype=np.float32)
+        scores[candidates] = self.factors[candidates].dot(preferences)
+        return scores
+
     def get_similar(self, post_counts, n=15):
         """
         Recommends subreddits based on the implicit matrix factorization model.
@@ -108,7 +197,8 @@ class Recommender(object):
 
         weighted = self._bm25(p)
         preferences = self._user_weights(weighted)
-        recommendations = self.factors.dot(preferences)
+        # Subreddits the user already posts in are skipped, so score enough candidates
+        recommendations = self._scores(preferences, n + len(indices))
         indices = recommendations.argsort()[::-1]
 
         result = list()
@@ -23,7 +23,8 @@ class RedditAPI(object):
         self.api_id = client_id
         self.api_secret = client_secret
         # Reddit API allows 60 requests per minute
-        self.requests_remaining = 60
+        self.ratelimit = 60
+        self.requests_remaining = self.ratelimit
         # Seconds to API ratelimit reset
         self.ratelimit_reset = 60
 
@@ -95,6 +96,14 @@ class RedditAPI(object):
             app.logger.error("Error retrieving data: %s", str(e))
             return {"error": str(e)}
 
+    def remaining(self):
+        """
+        Returns the number of requests left in the current ratelimit window.
+        """
+        if int(time.time()) - self.ratelimit_reset > 60:
+            return self.ratelimit
+        return self.requests_remaining
+
     def user(self, username):
         """
         Retrieve user information and latest posts from the reddit API.
@@ -137,9 +146,11 @@ class RedditAPI(object):
                 if l < posts_per_request:
                     break
 
+            now = int(time.time())
             data = {"info": user_info,
                     "username": username,
-                    "refreshed": parse_date(int(time.time()))}
+                    "refreshed": parse_date(now),
+                    "refreshed_utc": now}
             if posts:
                 data["posts"] = posts
 
@@ -0,0 +1,137 @@
+"""
+Background refreshing of frequently viewed profiles.
+
+Popularity keeps an exponentially decayed count of views per username.
+CacheWarmer periodically refreshes the most popular profiles whose data is
+getting old, using only part of the reddit API ratelimit so that interactive
+requests are not slowed down.
+"""
+import logging
+import math
+import threading
+import time
+
+
+class Popularity(object):
+    """
+    Decayed view counts of usernames.
+
+    Args:
+        half_life: seconds after which a view counts half
+        max_users: number of usernames tracked, least popular are dropped
+    """
+    def __init__(self, half_life=24 * 3600, max_users=10000):
+        self.decay = math.log(2) / half_life
+        self.max_users = max_users
+        # username -> (count, time of last update)
+        self.counts = dict()
+        self.lock = threading.RLock()
+
+    def _count(self, name, now):
+        count, updated = self.counts[name]
+        return count * math.exp(-self.decay * (now - updated))
+
+    def hit(self, name):
+        """
+        Records a view of a username.
+        """
+        now = time.time()
+        with self.lock:
+            count = self._count(name, now) if name in self.counts else 0.0
+            self.counts[name] = (count + 1.0, now)
+            if len(self.counts) > self.max_users:
+                # Drop the least popular tenth at once instead of on every view
+                for dropped in self.top(len(self.counts))[-(self.max_users // 10 + 1):]:
+                    del self.counts[dropped]
+
+    def top(self, n):
+        """
+        Returns the n most viewed usernames, most popular first.
+        """
+        now = time.time()
+        with self.lock:
+            names = sorted(self.counts, key=lambda name: -self._count(name, now))
+        return names[:n]
+
+
+class CacheWarmer(object):
+    """
+    Refreshes stale data of popular users with spare reddit API requests.
+
+    Args:
+        popularity: Popularity of usernames
+        api: RedditAPI used for retrieving the data
+        refresh: function retrieving and storing the data of a username
+        age: function returning the seconds since a username was refreshed,
+             or None if there is no data
+        max_age: seconds after which popular data is refreshed
+        budget: share of the API ratelimit the warmer may use per minute
+        reserve: requests per minute always left for interactive requests
+        cost: API requests needed for refreshing one user
+        candidates: number of most popular users checked for staleness per round
+        interval: seconds between refresh rounds
+        logger: logger for errors of refresh rounds
+    """
+    def __init__(self, popularity, api, refresh, age, max_age=6 * 3600,
+                 budget=0.25, reserve=20, cost=6, candidates=100, interval=60,
+                 logger=None):
+        self.popularity = popularity
+        self.api = api
+        self.refresh = refresh
+        self.age = age
+        self.max_age = max_age
+        self.budget = int(budget * api.ratelimit)
+        self.reserve = reserve
+        self.cost = cost
+        self.candidates = candidates
+        self.interval = interval
+        self.logger = logger or logging.getLogger(__name__)
+        # username -> time of last refresh attempt. Failed refreshes do not
+        # update the stored data, so this keeps them from being retried every round.
+        self.attempted = dict()
+
+    def warm(self):
+        """
+        Refreshes the most popular stale users within the request budget.
+
+        Returns:
+            list of refreshed usernames
+        """
+        now = time.time()
+        self.attempted = dict((k, v) for k, v in self.attempted.items()
+                              if now - v < self.max_age)
+
+        available = self.budget
+        refreshed = list()
+        for name in self.popularity.top(self.candidates):
+            # Interactive requests use the API during the round as well, so check
+            # the remaining requests again before each refresh
+            if min(available, self.api.remaining() - self.reserve) < self.cost:
+                break
+            if name in self.attempted:
+                continue
+            age = self.age(name)
+            if age is not None and age < self.max_age:
+                continue
+            self.attempted[name] = now
+            self.refresh(name)
+            refreshed.append(name)
+            available -= self.cost
+        return refreshed
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.warm()
+            except Exception as e:
+                # Keep the thread alive over transient errors, e.g. of the database
+                self.logger.error("Cache warming failed: %s", str(e))
+
+    def start(self):
+        """
+        Starts refreshing in a background thread.
+        """
+        thread = threading.Thread(target=self.run, daemon=True)
+        thread.start()
+        return thread